@@ -1,34 +1,353 @@
 import azure.functions as func
-import datetime
-import json
+import atexit
+import hashlib
+import httpx
 import logging
 from openai import AzureOpenAI
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
 from msal import ConfidentialClientApplication
+import msgspec
+import orjson
+import redis
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
+import re
+import threading
+import time
+from urllib.parse import quote
+from typing import Optional
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 app = func.FunctionApp()
 
+# Shared HTTP session, reused across warm invocations so Airtable calls keep
+# their TCP/TLS connections alive instead of reconnecting each time. Airtable
+# creates are not idempotent, so only failures where nothing can have been
+# committed (connect errors, 429) are retried.
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=100,
+    max_retries=Retry(
+        total=3,
+        connect=3,
+        read=0,
+        backoff_factor=0.3,
+        status_forcelist=[429],
+        allowed_methods=["POST"]
+    )
+))
+
+# HTTP/2 client for Microsoft Graph, multiplexing draft requests over one
+# kept-alive TLS connection
+_GRAPH = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=10, max_connections=50, keepalive_expiry=30.0),
+    timeout=30.0
+)
+
+# Graph endpoint for creating a draft in a user's mailbox, and the shape a
+# mailbox address must have before it is put into that URL
+_GRAPH_DRAFT_URL = "https://graph.microsoft.com/v1.0/users/{sender}/mailFolders/drafts/messages"
+_EMAIL_RE = re.compile(r"[A-Za-z0-9._+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}")
+
+# Worker pool for overlapping independent outbound calls
+_POOL = ThreadPoolExecutor(max_workers=8)
+
+# Airtable records are buffered per table URL and written with the bulk
+# create endpoint (up to 10 records per call), either by the background
+# flusher or inline as soon as a table has a full batch
+_AIRTABLE_BATCH_SIZE = 10
+_AIRTABLE_FLUSH_INTERVAL = 0.5
+_AIRTABLE_CONNECT_TIMEOUT = 3.05
+_AIRTABLE_WRITE_TIMEOUT = 10
+_AIRTABLE_BUFFERS = {}
+_AIRTABLE_LOCK = threading.Lock()
+
+def _queue_airtable_record(url, record):
+    with _AIRTABLE_LOCK:
+        buffer = _AIRTABLE_BUFFERS.setdefault(url, deque())
+        buffer.append(record)
+        batch_ready = len(buffer) >= _AIRTABLE_BATCH_SIZE
+    if batch_ready:
+        _flush_airtable()
+
+def _take_airtable_batches():
+    batches = []
+    with _AIRTABLE_LOCK:
+        for url, buffer in _AIRTABLE_BUFFERS.items():
+            while buffer:
+                count = min(_AIRTABLE_BATCH_SIZE, len(buffer))
+                batches.append((url, [buffer.popleft() for _ in range(count)]))
+    return batches
+
+def _post_airtable_batch(url, records):
+    # The created records echoed back are never used: stream the response and
+    # discard it chunk by chunk, so nothing is buffered or decoded while the
+    # connection still goes back to the pool fully read
+    with _SESSION.post(
+        url,
+        headers=_AIRTABLE_HEADERS,
+        data=orjson.dumps({"records": records}),
+        stream=True,
+        timeout=(_AIRTABLE_CONNECT_TIMEOUT, _AIRTABLE_WRITE_TIMEOUT)
+    ) as response:
+        response.raise_for_status()
+        for _ in response.iter_content(chunk_size=8192):
+            pass
+
+def _write_airtable_batch(url, records):
+    try:
+        _post_airtable_batch(url, records)
+    except Exception as e:
+        logging.error("Error writing %d records to Airtable: %s", len(records), e)
+
+def _flush_airtable():
+    # Batches for different tables are independent, so write them concurrently
+    futures = []
+    for url, records in _take_airtable_batches():
+        try:
+            futures.append((_POOL.submit(_post_airtable_batch, url, records), records))
+        except RuntimeError:
+            # The pool is shutting down; the batch is already out of the
+            # buffer, so write it on this thread rather than lose it
+            _write_airtable_batch(url, records)
+    for future, records in futures:
+        try:
+            future.result(timeout=_AIRTABLE_WRITE_TIMEOUT)
+        except Exception as e:
+            logging.error("Error writing %d records to Airtable: %s", len(records), e)
+
+def _flush_airtable_at_exit():
+    # The worker pool no longer accepts work during interpreter shutdown
+    for url, records in _take_airtable_batches():
+        _write_airtable_batch(url, records)
+
+def _airtable_flush_loop():
+    while True:
+        time.sleep(_AIRTABLE_FLUSH_INTERVAL)
+        # Keep the flusher alive whatever a single flush runs into
+        try:
+            _flush_airtable()
+        except Exception as e:
+            logging.error("Airtable flush failed: %s", e)
+
+threading.Thread(target=_airtable_flush_loop, daemon=True).start()
+atexit.register(_flush_airtable_at_exit)
+
+# System prompt shared by every request
+_SYSTEM_CONTENT = "You are a helpful assistant that drafts professional email replies. Be concise and polite."
+
+# Optional Redis backing the response cache and the message ledger
+_REDIS = None
+if os.environ.get("REDIS_URL"):
+    _REDIS = redis.Redis(connection_pool=redis.ConnectionPool.from_url(os.environ["REDIS_URL"]))
+
+class ResponseCache:
+    """Exact-match cache of generated replies, keyed by model, prompt and temperature.
+
+    Without a Redis client every lookup misses.
+    """
+
+    def __init__(self, client=None, ttl=86400):
+        self.ttl = ttl
+        self._redis = client
+
+    @staticmethod
+    def key(model, messages, temperature):
+        raw = model.encode('utf-8') + orjson.dumps(messages, option=orjson.OPT_SORT_KEYS) + str(temperature).encode('utf-8')
+        return f"reply:{hashlib.sha256(raw).hexdigest()}"
+
+    def lookup(self, key):
+        if self._redis is None:
+            return None
+        try:
+            cached = self._redis.get(key)
+        except redis.RedisError as e:
+            logging.warning("Response cache lookup failed: %s", e)
+            return None
+        return cached.decode('utf-8') if cached is not None else None
+
+    def update(self, key, value):
+        if self._redis is None:
+            return
+        try:
+            self._redis.setex(key, self.ttl, value)
+        except redis.RedisError as e:
+            logging.warning("Response cache update failed: %s", e)
+
+class MessageLedger:
+    """Tracks queue message ids so redelivered messages reuse their finished reply.
+
+    Without a Redis client nothing is tracked and every message is processed.
+    """
+
+    def __init__(self, client=None, ttl=3600):
+        self.ttl = ttl
+        self._redis = client
+
+    @property
+    def enabled(self):
+        return self._redis is not None
+
+    @staticmethod
+    def key(msg_id):
+        return f"msg:{msg_id}"
+
+    def claim(self, msg_id):
+        """Mark the message as in progress; return its reply if it already completed."""
+        if self._redis is None:
+            return None
+        key = self.key(msg_id)
+        try:
+            if self._redis.set(key, orjson.dumps({"status": "in_progress"}), nx=True, ex=self.ttl):
+                return None
+            stored = self._redis.get(key)
+        except redis.RedisError as e:
+            logging.warning("Message ledger claim failed: %s", e)
+            return None
+        if stored is None:
+            return None
+        entry = orjson.loads(stored)
+        if entry.get("status") == "done":
+            return entry.get("reply_content")
+        return None
+
+    def complete(self, msg_id, reply_content):
+        if self._redis is None:
+            return
+        entry = {"status": "done", "reply_content": reply_content}
+        try:
+            self._redis.set(self.key(msg_id), orjson.dumps(entry), ex=self.ttl)
+        except redis.RedisError as e:
+            logging.warning("Message ledger update failed: %s", e)
+
+_RESPONSE_CACHE = ResponseCache(_REDIS)
+_MESSAGE_LEDGER = MessageLedger(_REDIS)
+
+# Clients and the Graph access token are created once per worker and reused.
+# The OpenAI client runs on our own httpx client so its connection can be
+# pre-warmed like the others.
+_OPENAI_HTTP = httpx.Client(
+    limits=httpx.Limits(max_keepalive_connections=10, max_connections=50, keepalive_expiry=30.0)
+)
+_OPENAI_CLIENT = None
+_MSAL_APP = None
+_GRAPH_TOKEN = {"token": None, "exp": 0.0}
+_GRAPH_SCOPES = ["https://graph.microsoft.com/.default"]
+_CLIENT_LOCK = threading.Lock()
+_GRAPH_TOKEN_LOCK = threading.Lock()
+
+# Settings read from the environment once per worker by _init_once()
+_SETTINGS_LOADED = False
+_OPENAI_DEPLOYMENT = None
+_AIRTABLE_META_URL = None
+_AIRTABLE_TRAIN_URL = None
+_AIRTABLE_HEADERS = None
+_SYSTEM_MSG = {"role": "system", "content": _SYSTEM_CONTENT}
+
+def _init_once():
+    global _SETTINGS_LOADED, _OPENAI_DEPLOYMENT, _AIRTABLE_META_URL, _AIRTABLE_TRAIN_URL, _AIRTABLE_HEADERS
+    if _SETTINGS_LOADED:
+        return
+    with _CLIENT_LOCK:
+        if _SETTINGS_LOADED:
+            return
+        try:
+            _OPENAI_DEPLOYMENT = os.environ["AZURE_OPENAI_DEPLOYMENT_NAME"]
+            _AIRTABLE_META_URL = os.environ["AIRTABLE_URL_METADATA"]
+            _AIRTABLE_TRAIN_URL = os.environ["AIRTABLE_URL_TRAINING"]
+            _AIRTABLE_HEADERS = {
+                "Authorization": f"Bearer {os.environ['AIRTABLE_API_KEY']}",
+                "Content-Type": "application/json"
+            }
+        except KeyError as e:
+            raise RuntimeError(f"Missing required app setting {e}") from e
+        _SETTINGS_LOADED = True
+
+def _get_openai():
+    global _OPENAI_CLIENT
+    if _OPENAI_CLIENT is None:
+        with _CLIENT_LOCK:
+            if _OPENAI_CLIENT is None:
+                _OPENAI_CLIENT = AzureOpenAI(
+                    api_key=os.environ["AZURE_OPENAI_API_KEY"],
+                    azure_endpoint=os.environ["AZURE_OPENAI_ENDPOINT"],
+                    api_version="2024-02-01",
+                    http_client=_OPENAI_HTTP
+                )
+    return _OPENAI_CLIENT
+
+def _get_graph_token():
+    global _MSAL_APP
+    if _GRAPH_TOKEN["token"] and time.monotonic() < _GRAPH_TOKEN["exp"] - 60:
+        return _GRAPH_TOKEN["token"]
+
+    # Separate lock so a token refresh does not hold up other client setup
+    with _GRAPH_TOKEN_LOCK:
+        if _GRAPH_TOKEN["token"] and time.monotonic() < _GRAPH_TOKEN["exp"] - 60:
+            return _GRAPH_TOKEN["token"]
+        if _MSAL_APP is None:
+            _MSAL_APP = ConfidentialClientApplication(
+                os.environ["AZURE_CLIENT_ID"],
+                authority=f"https://login.microsoftonline.com/{os.environ['AZURE_TENANT_ID']}",
+                client_credential=os.environ["AZURE_CLIENT_SECRET"]
+            )
+        result = _MSAL_APP.acquire_token_for_client(scopes=_GRAPH_SCOPES)
+        access_token = result.get("access_token")
+        if access_token:
+            _GRAPH_TOKEN["token"] = access_token
+            _GRAPH_TOKEN["exp"] = time.monotonic() + result.get("expires_in", 0)
+        return access_token
+
+# Open TLS connections to each upstream in the background at cold start so
+# the first invocation reuses a kept-alive connection
+def _prewarm_connections():
+    warmups = [
+        (_GRAPH.head, "https://graph.microsoft.com"),
+        (_SESSION.head, "https://api.airtable.com")
+    ]
+    if os.environ.get("AZURE_OPENAI_ENDPOINT"):
+        warmups.append((_OPENAI_HTTP.head, os.environ["AZURE_OPENAI_ENDPOINT"]))
+    for head, url in warmups:
+        try:
+            head(url, timeout=2)
+        except Exception:
+            pass
+
+threading.Thread(target=_prewarm_connections, daemon=True).start()
+
+# Body accepted by the generate-email route; decoded and validated in one pass
+class EmailReq(msgspec.Struct, omit_defaults=True):
+    subject: str
+    body: str
+    sender_email: str
+    recipient_email: Optional[str] = None
+    recipient_name: Optional[str] = None
+
 # 1. HTTP route: send request data to queue
 @app.route(route="generate-email", methods=["POST"], auth_level=func.AuthLevel.ANONYMOUS)
 @app.queue_output(arg_name="generateEmailQueue", queue_name="generate-email-queue", connection="AzureWebJobsStorage")
 def generate_email(req: func.HttpRequest, generateEmailQueue: func.Out[str]) -> func.HttpResponse:
+    # Parse the raw body in one pass; an empty body is rejected without
+    # going through a decode error
+    body = req.get_body()
+    if not body:
+        return func.HttpResponse("Invalid JSON body.", status_code=400)
     try:
-        req_body = req.get_json()
-    except Exception as e:
-        logging.error(f"Error parsing request body: {e}")
+        req_body = msgspec.json.decode(body, type=EmailReq)
+    except msgspec.ValidationError as e:
+        logging.error("Invalid request body: %s", e)
+        return func.HttpResponse(str(e), status_code=400)
+    except msgspec.DecodeError as e:
+        logging.error("Error parsing request body: %s", e)
         return func.HttpResponse("Invalid JSON body.", status_code=400)
 
-    # Validate required fields
-    required_fields = ['subject', 'body', 'sender_email']
-    if not all(field in req_body for field in required_fields):
-        return func.HttpResponse(
-            "Please provide 'subject', 'body', and 'sender_email' in the request body.",
-            status_code=400
-        )
-
     # Send the request data to the queue as JSON
-    generateEmailQueue.set(json.dumps(req_body))
+    generateEmailQueue.set(msgspec.json.encode(req_body).decode('utf-8'))
     logging.info("Request data sent to generate-email-queue.")
 
     return func.HttpResponse(
@@ -36,17 +355,9 @@ def generate_email(req: func.HttpRequest, generateEmailQueue: func.Out[str]) ->
         status_code=202
     )
 
-# 2. Queue trigger: process messages and generate reply
-@app.queue_trigger(arg_name="msg", queue_name="generate-email-queue", connection="AzureWebJobsStorage")
-@app.queue_output(arg_name="outlookDraftQueue", queue_name="outlook-draft-queue", connection="AzureWebJobsStorage")
-def process_generate_email(msg: func.QueueMessage, outlookDraftQueue: func.Out[str]) -> None:
-    logging.info("Processing message from generate-email-queue.")
-    try:
-        req_body = json.loads(msg.get_body().decode('utf-8'))
-    except Exception as e:
-        logging.error(f"Error decoding queue message: {e}")
-        return
-
+# Generate the reply for one queued request; returns the draft payload, or
+# None if it could not be produced
+def _handle_one(req_body, msg_id, dequeue_count):
     # Extract fields
     original_email_subject = req_body.get('subject')
     original_email_body = req_body.get('body')
@@ -54,68 +365,75 @@ def process_generate_email(msg: func.QueueMessage, outlookDraftQueue: func.Out[s
     recipient_email = req_body.get('recipient_email')
     recipient_name = req_body.get('recipient_name')
 
+    # Missing settings are a configuration error: let it fail the invocation
+    # so the message is retried or poisoned instead of silently dropped
+    _init_once()
+
     # Initialize OpenAI client
     try:
-        api_key = os.environ["AZURE_OPENAI_API_KEY"]
-        azure_endpoint = os.environ["AZURE_OPENAI_ENDPOINT"]
-        deployment_name = os.environ["AZURE_OPENAI_DEPLOYMENT_NAME"]
-        openai_client = AzureOpenAI(
-            api_key=api_key,
-            azure_endpoint=azure_endpoint,
-            api_version="2024-02-01"
-        )
+        openai_client = _get_openai()
     except Exception as e:
-        logging.error(f"Error initializing Azure OpenAI client: {e}")
-        return
+        logging.error("Error initializing Azure OpenAI client: %s", e)
+        return None
 
     # Prepare prompt
-    system_role = "system"
-    system_content = "You are a helpful assistant that drafts professional email replies. Be concise and polite."
-    user_role = "user"
     user_content = f"The following is an email from '{sender_email}' with the subject '{original_email_subject}' and body:\n\n---\n'{original_email_body}'\n---\n\nDraft a concise and polite reply."
     if recipient_name:
         user_content += f"\n\nSign off as {recipient_name} with position as Magiccars Customer Care and email contact {recipient_email}."
 
-    prompt_messages = [
-        {"role": system_role, "content": system_content},
-        {"role": user_role, "content": user_content}
-    ]
+    user_msg = {"role": "user", "content": user_content}
+    prompt_messages = [_SYSTEM_MSG, user_msg]
 
-    # Generate reply
+    # Generate reply, reusing a finished one for redelivered messages or an
+    # identical earlier one when cached
+    temperature = 0.7
     try:
-        response = openai_client.chat.completions.create(
-            model=deployment_name,
-            messages=prompt_messages,
-            temperature=0.7,
-            max_tokens=250,
-            top_p=0.95,
-            frequency_penalty=0,
-            presence_penalty=0,
-            stop=None
-        )
-        
-        reply_content = response.choices[0].message.content.strip()
-        reply_subject = f"Re: {original_email_subject}"
-        logging.info(f"Reply generated: {reply_subject} - {reply_content[:100]}...")
+        reply_content = _MESSAGE_LEDGER.claim(msg_id)
+        cache_hit = reply_content is not None
+        if cache_hit:
+            logging.info("Message %s already processed (dequeue count %s); reusing its reply.", msg_id, dequeue_count)
+        else:
+            cache_key = _RESPONSE_CACHE.key(_OPENAI_DEPLOYMENT, prompt_messages, temperature)
+            reply_content = _RESPONSE_CACHE.lookup(cache_key)
+            cache_hit = reply_content is not None
+            if cache_hit:
+                logging.info("Reply served from response cache.")
+        if not cache_hit:
+            response = openai_client.chat.completions.create(
+                model=_OPENAI_DEPLOYMENT,
+                messages=prompt_messages,
+                temperature=temperature,
+                max_tokens=250,
+                top_p=0.95,
+                frequency_penalty=0,
+                presence_penalty=0,
+                stop=None,
+                stream=True
+            )
 
-        # Store as draft in Outlook
-        draft_payload = {
-            "subject": reply_subject,
-            "body": reply_content,
-            "recipient_email": sender_email,
-            "sender_email": recipient_email
-        }
+            # Accumulate the streamed tokens; Azure may send chunks without
+            # choices (e.g. content filter results)
+            parts = []
+            finish_reason = None
+            for chunk in response:
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                if choice.delta.content:
+                    parts.append(choice.delta.content)
+                if choice.finish_reason:
+                    finish_reason = choice.finish_reason
+            reply_content = "".join(parts).strip()
 
-        outlookDraftQueue.set(json.dumps(draft_payload))
-        logging.info("Reply sent to outlook-draft-queue.")
+            # A filtered or empty completion is not a reply: don't cache,
+            # record or draft it
+            if finish_reason == "content_filter" or not reply_content:
+                logging.error("No usable reply generated (finish reason: %s).", finish_reason)
+                return None
+            _RESPONSE_CACHE.update(cache_key, reply_content)
 
-        airtable_api_key = os.environ["AIRTABLE_API_KEY"]
-        airtable_url_metadata = os.environ["AIRTABLE_URL_METADATA"]
-        airtable_url_training = os.environ["AIRTABLE_URL_TRAINING"]
-        headers = {
-            "Authorization": f"Bearer {airtable_api_key}",
-            "Content-Type": "application/json"
-        }
+        reply_subject = f"Re: {original_email_subject}"
+        logging.info("Reply generated: %s - %.100s...", reply_subject, reply_content)
 
          # Email metadata record
         metadata_record = {
@@ -127,70 +445,91 @@ def process_generate_email(msg: func.QueueMessage, outlookDraftQueue: func.Out[s
                 "recipient_name": recipient_name
             }
         }
-        
-        requests.post(airtable_url_metadata, headers=headers, json=metadata_record)
-        
+
         # Dataset training record
         training_record = {
             "fields": {
-                "system_role": system_role,
-                "system_content": system_content,
-                "user_role": user_role,
-                "user_content": user_content,
+                "system_role": _SYSTEM_MSG["role"],
+                "system_content": _SYSTEM_MSG["content"],
+                "user_role": user_msg["role"],
+                "user_content": user_msg["content"],
                 "reply_draft": reply_content,
                 "reply_sent": "",
                 "status": "Draft"
             }
         }
-        
-        requests.post(airtable_url_training, headers=headers, json=training_record)
-        
+
+        # Buffer both records for the batched Airtable writer. A cached reply
+        # was already recorded when it was first generated.
+        if not cache_hit:
+            _queue_airtable_record(_AIRTABLE_META_URL, metadata_record)
+            _queue_airtable_record(_AIRTABLE_TRAIN_URL, training_record)
+
+        # Draft to create in Outlook
+        draft_payload = {
+            "subject": reply_subject,
+            "body": reply_content,
+            "recipient_email": sender_email,
+            "sender_email": recipient_email
+        }
+
+        _MESSAGE_LEDGER.complete(msg_id, reply_content)
+        return draft_payload
+
     except Exception as e:
-        logging.error(f"Error during OpenAI API call or reply generation: {e}")
+        logging.error("Error during OpenAI API call or reply generation: %s", e)
+        return None
 
-# 3. Queue trigger: process create draft email in outlook
-@app.route(route="create-outlook-draft", methods=["POST"], auth_level=func.AuthLevel.ANONYMOUS)
-def create_outlook_draft(req: func.HttpRequest) -> func.HttpResponse:
-    req_body = req.get_json()
+# Create the reply as a draft in the sender's Outlook mailbox through Graph,
+# retrying transient HTTP failures
+def _is_transient_graph_error(e):
+    # Token acquisition failures (AAD errors such as temporarily_unavailable,
+    # or MSAL's own network errors) happen before anything is sent to Graph.
+    # For the draft POST itself only retry when Graph cannot have created the
+    # draft: the connection was never made, or the request was throttled or
+    # refused as unavailable. Timeouts mid-request may already have created it.
+    if isinstance(e, (RuntimeError, requests.RequestException)):
+        return True
+    if isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+        return True
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in (429, 503)
+    return False
 
-    # Get credentials from environment variables
-    tenant_id = os.environ["AZURE_TENANT_ID"]
-    client_id = os.environ["AZURE_CLIENT_ID"]
-    client_secret = os.environ["AZURE_CLIENT_SECRET"]
-
-    # Authenticate with Microsoft Graph
-    authority = f"https://login.microsoftonline.com/{tenant_id}"
-    app = ConfidentialClientApplication(
-        client_id,
-        authority=authority,
-        client_credential=client_secret
-    )
-    scopes = ["https://graph.microsoft.com/.default"]
-    result = app.acquire_token_for_client(scopes=scopes)
-    access_token = result.get("access_token")
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=0.5, max=8),
+    retry=retry_if_exception(_is_transient_graph_error),
+    reraise=True
+)
+def _create_draft_in_outlook(payload):
+    sender = payload['sender_email']
+    if not isinstance(sender, str) or not _EMAIL_RE.fullmatch(sender):
+        raise ValueError("Invalid sender_email for Outlook draft.")
 
+    # Authenticate with Microsoft Graph (cached until shortly before expiry)
+    access_token = _get_graph_token()
     if not access_token:
-        logging.error("Could not obtain access token for Microsoft Graph.")
-        return
+        raise RuntimeError("Could not obtain access token for Microsoft Graph.")
 
     # Create draft email payload
     draft_payload = {
         "message": {
-            "subject": req_body["subject"],
+            "subject": payload["subject"],
             "body": {
                 "contentType": "Text",
-                "content": req_body["body"]
+                "content": payload["body"]
             },
             "toRecipients": [
                 {
                     "emailAddress": {
-                        "address": req_body["recipient_email"]
+                        "address": payload["recipient_email"]
                     }
                 }
             ],
             "from": {
                 "emailAddress": {
-                    "address": req_body["sender_email"]
+                    "address": sender
                 }
             }
         },
@@ -198,16 +537,61 @@ def create_outlook_draft(req: func.HttpRequest) -> func.HttpResponse:
     }
 
     # Send request to create draft
-    url = f"https://graph.microsoft.com/v1.0/users/{req_body["sender_email"]}/mailFolders/drafts/messages"
+    url = _GRAPH_DRAFT_URL.format(sender=quote(sender, safe="@"))
     headers = {
         "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json"
     }
-    response = requests.post(url, headers=headers, json=draft_payload)
-    if response.status_code == 201:
-        logging.info("Draft email created successfully in Outlook.")
-        return func.HttpResponse("Draft created.", status_code=201)
-    else:
-        logging.error(f"Failed to create draft email: {response.text}")
-        return func.HttpResponse("Failed to create draft.", status_code=response.status_code)
-    
\ No newline at end of file
+    response = _GRAPH.post(url, headers=headers, content=orjson.dumps(draft_payload))
+    response.raise_for_status()
+    logging.info("Draft email created successfully in Outlook.")
+
+# 2. Queue trigger: process messages, generate reply and create the Outlook draft
+@app.queue_trigger(arg_name="msg", queue_name="generate-email-queue", connection="AzureWebJobsStorage")
+def process_generate_email(msg: func.QueueMessage) -> None:
+    logging.info("Processing message from generate-email-queue.")
+    try:
+        req_body = orjson.loads(msg.get_body())
+    except Exception as e:
+        logging.error("Error decoding queue message: %s", e)
+        return
+
+    draft_payload = _handle_one(req_body, msg.id, msg.dequeue_count)
+    if draft_payload is None:
+        return
+
+    # The draft is created in the mailbox the email was sent to, which the
+    # request does not always include
+    if not draft_payload.get("sender_email"):
+        logging.warning("No recipient_email in request; skipping Outlook draft.")
+        return
+
+    # Transient Graph failures are re-raised so the message is retried, but
+    # only when the message ledger can make the redelivery reuse the stored
+    # reply. Without it a redelivery would call OpenAI again and add another
+    # pair of Airtable rows. Anything else would fail the same way every time.
+    try:
+        _create_draft_in_outlook(draft_payload)
+    except Exception as e:
+        logging.error("Failed to create draft email: %s", e)
+        if _is_transient_graph_error(e) and _MESSAGE_LEDGER.enabled:
+            raise
+
+# 3. HTTP route: create draft email in outlook (kept for existing callers)
+@app.route(route="create-outlook-draft", methods=["POST"], auth_level=func.AuthLevel.ANONYMOUS)
+def create_outlook_draft(req: func.HttpRequest) -> func.HttpResponse:
+    req_body = req.get_json()
+
+    try:
+        _create_draft_in_outlook(req_body)
+    except ValueError as e:
+        logging.error("Invalid Outlook draft request: %s", e)
+        return func.HttpResponse("Invalid sender_email.", status_code=400)
+    except httpx.HTTPStatusError as e:
+        logging.error("Failed to create draft email: %s", e.response.text)
+        return func.HttpResponse("Failed to create draft.", status_code=e.response.status_code)
+    except Exception as e:
+        logging.error("Failed to create draft email: %s", e)
+        return func.HttpResponse("Failed to create draft.", status_code=500)
+
+    return func.HttpResponse("Draft created.", status_code=201)